@@ -1,18 +1,27 @@
 from prefect import flow, task
-import subprocess
+import os
+import sys
+
+# Path setup for module imports
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from src.ingestion.download_tlc import main as download_main
+from src.transforms.clean_tlc import main as clean_main
 
 @task
 def download():
-    subprocess.run(["python", "nyc-tlc-pipeline/src/ingestion/download_tlc.py"])
+    return download_main()
 
 @task
-def clean():
-    subprocess.run(["python", "nyc-tlc-pipeline/src/transforms/clean_tlc.py"])
+def clean(raw_path):
+    return clean_main(raw_path)
 
 @flow
 def pipeline():
-    download()
-    clean()
+    # submit so Prefect records each task's state and exception, clean waits on download
+    raw_path = download.submit()
+    cleaned_path = clean.submit(raw_path)
+    return cleaned_path.result()
 
 if __name__ == "__main__":
-    pipeline()
\ No newline at end of file
+    pipeline()
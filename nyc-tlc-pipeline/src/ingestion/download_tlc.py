@@ -1,32 +1,51 @@
 import requests
 import os
+import shutil
 import sys
 
 # Path setup for module imports
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
 from config import url, filename
-   
-try:
-    os.makedirs("nyc-tlc-pipeline/data/raw", exist_ok=True)
-    print("Directory created/exists")
-       
-    print("Starting download...")
-    response = requests.get(url)
-    response.raise_for_status()  # Raises an exception for bad status codes
-       
-    print(f"Download complete. Content size: {len(response.content)} bytes")
-       
-    with open(f"nyc-tlc-pipeline/data/raw/{filename}", "wb") as f:
-        f.write(response.content)
+
+
+def main():
+    raw_path = f"nyc-tlc-pipeline/data/raw/{filename}"
+
+    try:
+        os.makedirs("nyc-tlc-pipeline/data/raw", exist_ok=True)
+        print("Directory created/exists")
+           
+        print("Starting download...")
+        # Stream straight to disk in 1MB chunks rather than holding the whole file in memory
+        # Write to a .part file so a failed download never truncates the previous good file
+        part_path = raw_path + ".part"
+        with requests.get(url, stream=True, timeout=(5, 60)) as response:
+            response.raise_for_status()  # Raises an exception for bad status codes
+            response.raw.decode_content = True
+               
+            with open(part_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+               
+        os.replace(part_path, raw_path)
+        print("Download complete.")
+               
+        # Verify file was written
+        file_size = os.path.getsize(raw_path)
+        print(f"File saved successfully! Size: {file_size} bytes")
            
-    # Verify file was written
-    file_size = os.path.getsize(f"nyc-tlc-pipeline/data/raw/{filename}")
-    print(f"File saved successfully! Size: {file_size} bytes")
-       
-except requests.exceptions.RequestException as e:
-    print(f"Network error: {e}")
-except OSError as e:
-    print(f"File system error: {e}")
-except Exception as e:
-    print(f"Unexpected error: {e}")
\ No newline at end of file
+    except requests.exceptions.RequestException as e:
+        print(f"Network error: {e}")
+        raise
+    except OSError as e:
+        print(f"File system error: {e}")
+        raise
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        raise
+
+    return raw_path
+
+
+if __name__ == "__main__":
+    main()
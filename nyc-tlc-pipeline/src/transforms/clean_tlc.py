@@ -7,19 +7,33 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")
 
 from config import filename, date_part
 
-# Load CSV/Parquet
-con = duckdb.connect()
-df = con.execute(f"SELECT * FROM 'nyc-tlc-pipeline/data/raw/{filename}'").df()
 
-# Clean step: remove negative fares
-df = df[df["fare_amount"] >= 0]
+def main(raw_path=f"nyc-tlc-pipeline/data/raw/{filename}"):
+    cleaned_path = f"nyc-tlc-pipeline/data/cleaned/cleaned_trips_{date_part}.parquet"
 
-# Clean step: remove 0 mile trips
-df = df[df["trip_distance"] > 0.1]
+    # Create output directory if it doesn't exist
+    os.makedirs("nyc-tlc-pipeline/data/cleaned", exist_ok=True)
 
-# Create output directory if it doesn't exist
-os.makedirs("nyc-tlc-pipeline/data/cleaned", exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"PRAGMA threads={os.cpu_count() or 1}")
 
-# Save cleaned data
-df.to_parquet(f"nyc-tlc-pipeline/data/cleaned/cleaned_trips_{date_part}.parquet")
-print("Cleaned data saved!")
+    # Clean steps: remove negative fares and 0 mile trips
+    # Filter and write the parquet in one pass, nothing is loaded into Python
+    # The COPY target can't be a parameter, so it stays a (quote escaped) literal
+    target = cleaned_path.replace("'", "''")
+    con.execute(f"""
+        COPY (
+            SELECT * FROM read_parquet(?)
+            WHERE fare_amount >= 0
+              AND trip_distance > 0.1
+        ) TO '{target}'
+        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 200000)
+    """, [raw_path])
+    con.close()
+    print("Cleaned data saved!")
+
+    return cleaned_path
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,11 @@
 Validate Spotify data between files and PostgreSQL
 """
 
-import pandas as pd
-import psycopg2
+import pyarrow.parquet as pq
+import psycopg
 from dotenv import load_dotenv
 import os
+import random
 
 load_dotenv("airflow.env")
 
@@ -37,25 +38,73 @@ FILES = {
 def count_rows_file(filepath):
     """Get row count from CSV or parquet"""
     if filepath.endswith('.parquet'):
-        df = pd.read_parquet(filepath)
-        return len(df)
+        # row count is in the footer, no need to read any data
+        return pq.ParquetFile(filepath).metadata.num_rows
     else:
-        # faster than loading whole CSV
-        return sum(1 for _ in open(filepath, encoding="utf-8")) - 1
-
-
-def count_rows_db(cur, table):
-    cur.execute(f"SELECT COUNT(*) FROM {table}")
-    return cur.fetchone()[0]
+        # count newlines over 1MB binary reads, faster than iterating lines
+        lines, last = 0, b"\n"
+        with open(filepath, "rb") as f:
+            for buf in iter(lambda: f.read(1024 * 1024), b""):
+                lines += buf.count(b"\n")
+                last = buf[-1:]
+        # a last line without a trailing newline still counts
+        if last != b"\n":
+            lines += 1
+        return lines - 1
+
+
+FK_CHECKS = [
+    ("artist_id", "artists"),
+    ("track_id", "tracks"),
+    ("region_id", "region")
+]
+
+
+def fetch_db_checks(cur):
+    """Run all the DB side checks in a single query, returns {column: value}"""
+    counts = ",\n".join(f"(SELECT COUNT(*) FROM {t}) AS rows_{t}" for t in FILES)
+    orphans = ",\n".join(
+        f"COUNT(*) FILTER (WHERE {t}.{col} IS NULL) AS orphans_{col}" for col, t in FK_CHECKS
+    )
+    joins = "\n".join(
+        f"LEFT JOIN {t} ON ce.{col} = {t}.{col}" for col, t in FK_CHECKS
+    )
+    
+    # fk orphans and nulls share one scan of chart_entries
+    cur.execute(f"""
+        WITH counts AS (
+            SELECT {counts}
+        ),
+        entry_checks AS (
+            SELECT
+                {orphans},
+                COUNT(*) FILTER (
+                    WHERE ce.chart_date IS NULL OR ce.chart_position IS NULL OR ce.streams IS NULL
+                ) AS nulls
+            FROM chart_entries ce
+            {joins}
+        ),
+        dup_checks AS (
+            SELECT COUNT(*) AS dups FROM (
+                SELECT 1
+                FROM chart_entries
+                GROUP BY artist_id, track_id, region_id, chart_position, chart_date
+                HAVING COUNT(*) > 1
+            ) dup
+        )
+        SELECT * FROM counts, entry_checks, dup_checks;
+    """)
+    cols = [d[0] for d in cur.description]
+    return dict(zip(cols, cur.fetchone()))
 
 
-def check_row_counts(cur):
+def check_row_counts(db):
     print("\nRow counts:")
     all_match = True
     
     for table, filepath in FILES.items():
         file_cnt = count_rows_file(filepath)
-        db_cnt = count_rows_db(cur, table)
+        db_cnt = db[f"rows_{table}"]
         match = file_cnt == db_cnt
         all_match = all_match and match
         
@@ -65,23 +114,12 @@ def check_row_counts(cur):
     return all_match
 
 
-def check_foreign_keys(cur):
+def check_foreign_keys(db):
     print("\nForeign key integrity:")
     all_ok = True
     
-    fk_checks = [
-        ("artist_id", "artists"),
-        ("track_id", "tracks"),
-        ("region_id", "region")
-    ]
-    
-    for col, ref_table in fk_checks:
-        cur.execute(f"""
-            SELECT COUNT(*) FROM chart_entries ce
-            LEFT JOIN {ref_table} t ON ce.{col} = t.{col}
-            WHERE t.{col} IS NULL;
-        """)
-        missing = cur.fetchone()[0]
+    for col, ref_table in FK_CHECKS:
+        missing = db[f"orphans_{col}"]
         all_ok = all_ok and (missing == 0)
         
         status = "✓" if missing == 0 else f"✗ {missing:,} orphaned"
@@ -90,29 +128,17 @@ def check_foreign_keys(cur):
     return all_ok
 
 
-def check_nulls(cur):
+def check_nulls(db):
     print("\nNull checks:")
-    cur.execute("""
-        SELECT COUNT(*) FROM chart_entries
-        WHERE chart_date IS NULL OR chart_position IS NULL OR streams IS NULL;
-    """)
-    nulls = cur.fetchone()[0]
+    nulls = db["nulls"]
     status = "✓" if nulls == 0 else f"✗ {nulls:,} null values"
     print(f"  critical fields {status}")
     return nulls == 0
 
 
-def check_duplicates(cur):
+def check_duplicates(cur, db):
     print("\nDuplicate checks:")
-    cur.execute("""
-        SELECT COUNT(*) FROM (
-            SELECT artist_id, track_id, region_id, chart_position, chart_date
-            FROM chart_entries
-            GROUP BY artist_id, track_id, region_id, chart_position, chart_date
-            HAVING COUNT(*) > 1
-        ) dup;
-    """)
-    dups = cur.fetchone()[0]
+    dups = db["dups"]
     
     if dups > 0:
         # show some examples
@@ -138,11 +164,13 @@ def spot_check_data(cur):
     print("\nSpot check:")
     
     # grab random row from parquet and check columns
-    df = pd.read_parquet(FILES["chart_entries"])
-    print(f"  Parquet columns: {list(df.columns)}")
+    # only one random row group is read rather than the whole file
+    pf = pq.ParquetFile(FILES["chart_entries"])
+    print(f"  Parquet columns: {pf.schema_arrow.names}")
     
-    sample = df.sample(1).iloc[0]
-    print("  sample record:", ",        ".join(map(str, [x.item() if hasattr(x, 'item') else x for x in sample.to_list()])))
+    row_group = pf.read_row_group(random.randrange(pf.num_row_groups))
+    sample = row_group.slice(random.randrange(row_group.num_rows), 1).to_pylist()[0]
+    print("  sample record:", ",        ".join(map(str, sample.values())))
     
     # find same row in DB (use whatever column names exist in parquet)
     try:
@@ -150,7 +178,8 @@ def spot_check_data(cur):
         track_id = int(sample['track_id'])
         region_id = int(sample['region_id'])
         chart_position = int(sample['chart_position'])
-        chart_date = str(sample['chart_date'])[:10]
+        # already a date from the parquet type, passed to postgres as is
+        chart_date = sample['chart_date']
         
         cur.execute("""
             SELECT artist_id, track_id, region_id, chart_position, streams, chart_date
@@ -175,18 +204,20 @@ def spot_check_data(cur):
 
 
 def run_validation():
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = psycopg.connect(**DB_CONFIG)
     cur = conn.cursor()
     
     print("\n" + "=" * 50)
     print("Spotify Data Validation")
     print("=" * 50)
     
+    db = fetch_db_checks(cur)
+    
     checks = []
-    checks.append(("Row counts", check_row_counts(cur)))
-    checks.append(("Foreign keys", check_foreign_keys(cur)))
-    checks.append(("Null values", check_nulls(cur)))
-    checks.append(("Duplicates", check_duplicates(cur)))
+    checks.append(("Row counts", check_row_counts(db)))
+    checks.append(("Foreign keys", check_foreign_keys(db)))
+    checks.append(("Null values", check_nulls(db)))
+    checks.append(("Duplicates", check_duplicates(cur, db)))
     checks.append(("Spot check", spot_check_data(cur)))
     
     cur.close()
@@ -2,7 +2,10 @@
 Normalize Spotify charts data into dimension and fact tables
 """
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from pathlib import Path
 from dotenv import load_dotenv
 import os
@@ -14,20 +17,31 @@ RAW_FILE = Path(f"{DATA_DIR}/raw/charts.csv")
 OUTPUT_DIR = Path(f"{DATA_DIR}/splits")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-CHUNK_SIZE = 100000
+# heavily repeated string columns, read dictionary encoded
+DICT_COLUMNS = ["title", "artist", "url", "region", "chart", "trend"]
 
 
-def load_raw_data(filepath, chunk_sz=None):
+def strip_categories(col):
+    """Strip whitespace once per category instead of once per row"""
+    stripped = col.cat.categories.str.strip()
+    # stripping can merge categories, np.unique also keeps them sorted
+    categories, remap = np.unique(stripped, return_inverse=True)
+    # only remap non-null codes, remap is empty when the column is all null
+    old_codes = col.cat.codes.to_numpy()
+    codes = np.full(len(col), -1)
+    mask = old_codes >= 0
+    codes[mask] = remap[old_codes[mask]]
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def load_raw_data(filepath):
     """Load and clean the raw CSV"""
     print("Loading raw CSV...")
     
-    if chunk_sz:
-        chunks = []
-        for chunk in pd.read_csv(filepath, chunksize=chunk_sz):
-            chunks.append(chunk)
-        df = pd.concat(chunks, ignore_index=True)
-    else:
-        df = pd.read_csv(filepath)
+    # multi-threaded arrow parse, repeated strings come through as categoricals
+    dict_type = pa.dictionary(pa.int32(), pa.string())
+    convert = pa_csv.ConvertOptions(column_types={c: dict_type for c in DICT_COLUMNS})
+    df = pa_csv.read_csv(filepath, convert_options=convert).to_pandas()
     
     # rename some columns to be clearer
     df.rename(columns={
@@ -43,9 +57,9 @@ def load_raw_data(filepath, chunk_sz=None):
     
     # basic cleanup
     df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
-    df["artist_name"] = df["artist_name"].str.strip()
-    df["track_name"] = df["track_name"].str.strip()
-    df["country_name"] = df["country_name"].str.strip()
+    df["artist_name"] = strip_categories(df["artist_name"])
+    df["track_name"] = strip_categories(df["track_name"])
+    df["country_name"] = strip_categories(df["country_name"])
     df["chart_date"] = pd.to_datetime(df["chart_date"], errors="coerce").dt.date
     df['streams'] = df['streams'].fillna(0).astype(int)
     
@@ -131,7 +145,7 @@ def save_tables(artists, tracks, regions, entries):
 
 
 def main():
-    df = load_raw_data(RAW_FILE, CHUNK_SIZE)
+    df = load_raw_data(RAW_FILE)
     
     artists = extract_artists(df)
     regions = extract_regions(df)
@@ -1,13 +1,24 @@
 """
 Load Spotify chart data into PostgreSQL with yearly partitioning.
 Handles CSVs for dimension tables and parquet for the main fact table.
+
+Reruns load incrementally, which assumes the normalized files are append-only:
+the normalize step rebuilds every id from scratch, so an id is only safe to
+reuse if it still points at the same row. The loader checks this and stops if
+an existing id changed or a row disappeared, set FULL_RELOAD=1 to drop the
+tables and load everything from scratch instead.
 """
 
-import psycopg2
-import pandas as pd
+import psycopg
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from io import StringIO
+from pgpq import ArrowToPostgresBinaryEncoder
+from psycopg.copy import QueuedLibpqWriter
+import duckdb
 
 load_dotenv("local.env")
 
@@ -22,6 +33,9 @@ DB_CONFIG = {
 
 DATA_DIR = os.getenv("DATA_DIR") + "/splits"
 
+# drop and rebuild every table instead of loading incrementally
+FULL_RELOAD = os.getenv("FULL_RELOAD") == "1"
+
 TABLE_FILES = {
     "artists": f"{DATA_DIR}/artists.csv",
     "tracks": f"{DATA_DIR}/tracks.csv",
@@ -29,67 +43,99 @@ TABLE_FILES = {
     "chart_entries": f"{DATA_DIR}/chart_entries_normalized.parquet"
 }
 
-CHUNK_SIZE = 100000
+# primary key of each dimension table, used to upsert reloads
+DIMENSION_KEYS = {
+    "artists": "artist_id",
+    "tracks": "track_id",
+    "region": "region_id"
+}
+
+CHUNK_SIZE = 500000
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# arrow types matching the chart_entries columns, binary COPY needs exact types
+CHART_ENTRIES_SCHEMA = pa.schema([
+    ("entry_id", pa.int32()),
+    ("artist_id", pa.int32()),
+    ("track_id", pa.int32()),
+    ("region_id", pa.int32()),
+    ("chart_date", pa.date32()),
+    ("chart_position", pa.int32()),
+    ("streams", pa.int64())
+])
 
 def dedupe_chart_entries(parquet_path):
     """Remove duplicates from chart entries, keeping highest streams"""
     print(f"\nChecking for duplicates in {parquet_path}...")
-    df = pd.read_parquet(parquet_path)
-    original_count = len(df)
+    con = duckdb.connect()
+    con.execute(f"PRAGMA threads={os.cpu_count() or 1}")
     
     key_cols = ['artist_id', 'track_id', 'region_id', 'chart_position', 'chart_date']
-    dupes = df.duplicated(subset=key_cols, keep=False)
-    dupe_count = dupes.sum()
+    keys = ", ".join(key_cols)
+    
+    # rows sharing a key with at least one other row
+    dupes = f"""
+        SELECT *, COUNT(*) OVER (PARTITION BY {keys}) AS cnt
+        FROM read_parquet(?)
+    """
+    dupe_count = con.execute(f"SELECT COUNT(*) FROM ({dupes}) WHERE cnt > 1", [parquet_path]).fetchone()[0]
     
     if dupe_count > 0:
         print(f"  Found {dupe_count:,} duplicate rows")
         
         # show a couple examples
         print("  Sample duplicates:")
-        sample = df[dupes].head(4)[key_cols + ['streams']]
-        for _, row in sample.iterrows():
-            print(f"    artist={row['artist_id']}, track={row['track_id']}, "
-                  f"region={row['region_id']}, chart_position={row['chart_position']}, date={row['chart_date']}, streams={row['streams']}")
+        sample = con.execute(f"SELECT {keys}, streams FROM ({dupes}) WHERE cnt > 1 LIMIT 4", [parquet_path]).fetchall()
+        for artist_id, track_id, region_id, chart_position, chart_date, streams in sample:
+            print(f"    artist={artist_id}, track={track_id}, "
+                  f"region={region_id}, chart_position={chart_position}, date={chart_date}, streams={streams}")
         
         # keep highest streams
         print("  Deduplicating (keeping highest streams)...")
-        df = df.sort_values('streams', ascending=False).drop_duplicates(
-            subset=key_cols,
-            keep='first'
-        )
-        
-        removed = original_count - len(df)
-        print(f"  Removed {removed:,} duplicates")
-        
-        # save clean version
         clean_path = parquet_path.replace('.parquet', '_clean.parquet')
         print(f"  Saving clean data to {clean_path}")
-        df.to_parquet(clean_path)
+        # the COPY target can't be a parameter, so it stays a (quote escaped) literal
+        target = clean_path.replace("'", "''")
+        con.execute(f"""
+            COPY (
+                SELECT * EXCLUDE (rn) FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY streams DESC) AS rn
+                    FROM read_parquet(?)
+                ) WHERE rn = 1
+            ) TO '{target}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """, [parquet_path])
+        
+        removed = pq.ParquetFile(parquet_path).metadata.num_rows - pq.ParquetFile(clean_path).metadata.num_rows
+        print(f"  Removed {removed:,} duplicates")
         
-        return df, clean_path
+        con.close()
+        return clean_path
     else:
         print("  No duplicates found")
-        return df, parquet_path
+        con.close()
+        return parquet_path
 
 
-def setup_schema(cur):
-    """Drop and recreate all tables"""
-    # clean slate
-    cur.execute("DROP TABLE IF EXISTS chart_entries CASCADE;")
-    cur.execute("DROP TABLE IF EXISTS tracks CASCADE;")
-    cur.execute("DROP TABLE IF EXISTS artists CASCADE;")
-    cur.execute("DROP TABLE IF EXISTS region CASCADE;")
+def setup_schema(cur, full_reload=False):
+    """Create any tables that don't exist yet, existing data is kept unless full_reload"""
+    if full_reload:
+        print("  Full reload, dropping existing tables")
+        cur.execute("DROP TABLE IF EXISTS chart_entries_staging;")
+        cur.execute("DROP TABLE IF EXISTS chart_entries CASCADE;")
+        cur.execute("DROP TABLE IF EXISTS tracks CASCADE;")
+        cur.execute("DROP TABLE IF EXISTS artists CASCADE;")
+        cur.execute("DROP TABLE IF EXISTS region CASCADE;")
     
     # dimension tables first
     cur.execute("""
-        CREATE TABLE artists (
+        CREATE TABLE IF NOT EXISTS artists (
             artist_id INT PRIMARY KEY,
             artist_name TEXT
         );
     """)
     
     cur.execute("""
-        CREATE TABLE tracks (
+        CREATE TABLE IF NOT EXISTS tracks (
             track_id INT PRIMARY KEY,
             track_name TEXT,
             artist_id INT REFERENCES artists(artist_id),
@@ -98,34 +144,85 @@ def setup_schema(cur):
     """)
     
     cur.execute("""
-        CREATE TABLE region (
+        CREATE TABLE IF NOT EXISTS region (
             region_id INT PRIMARY KEY,
             country_name TEXT
         );
     """)
     
     # main table with partitioning
+    # keys are added after the first bulk load, see add_chart_entries_constraints
     cur.execute("""
-        CREATE TABLE chart_entries (
+        CREATE TABLE IF NOT EXISTS chart_entries (
             entry_id INT,
-            artist_id INT REFERENCES artists(artist_id),
-            track_id INT REFERENCES tracks(track_id),
-            region_id INT REFERENCES region(region_id),
+            artist_id INT,
+            track_id INT,
+            region_id INT,
             chart_date DATE NOT NULL,
             chart_position INT,
-            streams BIGINT,
-            PRIMARY KEY (entry_id, chart_date)
+            streams BIGINT
         ) PARTITION BY RANGE (chart_date);
     """)
+    
+    # later runs COPY in here first and merge, no WAL needed for throwaway rows
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS chart_entries_staging
+        (LIKE chart_entries INCLUDING DEFAULTS);
+    """)
+
+
+def chart_entries_has_keys(cur):
+    """True once the first load has added the chart_entries primary key"""
+    cur.execute("""
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'chart_entries'::regclass AND contype = 'p';
+    """)
+    return cur.fetchone() is not None
+
+
+def add_chart_entries_constraints(cur):
+    """Add the fact table keys once the data is in"""
+    # one index build and one validation scan per key instead of a lookup per row
+    # (postgres doesn't allow NOT VALID foreign keys on partitioned tables)
+    print("\nAdding chart_entries constraints...")
+    cur.execute("ALTER TABLE chart_entries ADD PRIMARY KEY (entry_id, chart_date);")
+    
+    fk_checks = [
+        ("artist_id", "artists"),
+        ("track_id", "tracks"),
+        ("region_id", "region")
+    ]
+    for col, ref_table in fk_checks:
+        cur.execute(f"""
+            ALTER TABLE chart_entries
+            ADD CONSTRAINT chart_entries_{col}_fkey
+            FOREIGN KEY ({col}) REFERENCES {ref_table}({col});
+        """)
+        print(f"  - {col} -> {ref_table}")
+
+
+def add_chart_entries_indexes(cur):
+    """Make sure the reporting indexes exist, whichever way the fact table was loaded"""
+    # cascades to every yearly partition, backs the per-year reporting queries
+    cur.execute("CREATE INDEX IF NOT EXISTS chart_entries_date_track_idx ON chart_entries (chart_date, track_id);")
 
 
 def setup_partitions(cur, parquet_file):
     """Figure out year range and create partitions"""
-    df = pd.read_parquet(parquet_file)
-    df['chart_date'] = pd.to_datetime(df['chart_date'])
+    # min/max come from the row group statistics in the footer, no data is read
+    meta = pq.ParquetFile(parquet_file).metadata
+    col = meta.schema.names.index('chart_date')
+    stats = [meta.row_group(i).column(col).statistics for i in range(meta.num_row_groups)]
     
-    start_year = df['chart_date'].min().year
-    end_year = df['chart_date'].max().year
+    if all(s is not None and s.has_min_max for s in stats):
+        start_year = min(s.min for s in stats).year
+        end_year = max(s.max for s in stats).year
+    else:
+        # no statistics written, read just chart_date, it's already a date type so no parsing
+        dates = pq.read_table(parquet_file, columns=['chart_date']).column('chart_date')
+        bounds = pc.min_max(dates).as_py()
+        start_year = bounds['min'].year
+        end_year = bounds['max'].year
     
     print(f"Creating partitions for {start_year}-{end_year}...")
     
@@ -138,48 +235,150 @@ def setup_partitions(cur, parquet_file):
         print(f"  - chart_entries_{yr}")
 
 
+def check_append_only(table, changed, missing):
+    """Stop the load if the source file isn't a pure append of what's loaded"""
+    if changed or missing:
+        raise ValueError(
+            f"{table}: {changed:,} existing rows changed and {missing:,} rows are missing from the "
+            f"new file, ids are no longer stable so it can't be loaded incrementally. "
+            f"Rerun with FULL_RELOAD=1 to rebuild the tables from scratch."
+        )
+
+
 def load_csv(cur, table, filepath):
-    """Standard CSV load with COPY"""
+    """COPY a CSV into a temp table then append the new ids to the real one"""
     if not os.path.exists(filepath):
         print(f"Warning: {filepath} not found")
         return
     
-    print(f"Loading {table}...", end=" ")
-    with open(filepath, "r", encoding="utf-8") as f:
-        cur.copy_expert(f"COPY {table} FROM STDIN WITH CSV HEADER", f)
-    print("done")
+    # bulk load, no need to wait on the WAL flush for this transaction
+    cur.execute("SET LOCAL synchronous_commit = OFF")
+    cur.execute(f"CREATE TEMP TABLE {table}_staging (LIKE {table}) ON COMMIT DROP;")
+    # raw bytes in 1MB reads, COPY does the decoding server side
+    with open(filepath, "rb", buffering=COPY_BUFFER_SIZE) as f, \
+            cur.copy(f"COPY {table}_staging FROM STDIN WITH CSV HEADER") as copy:
+        while data := f.read(COPY_BUFFER_SIZE):
+            copy.write(data)
+    
+    # ids are rebuilt by the normalize step, so an existing id has to still mean the same row
+    key = DIMENSION_KEYS[table]
+    cur.execute(f"""
+        SELECT
+            COUNT(*) FILTER (WHERE s.{key} IS NOT NULL AND ROW(s.*) IS DISTINCT FROM ROW(t.*)),
+            COUNT(*) FILTER (WHERE s.{key} IS NULL)
+        FROM {table} t
+        LEFT JOIN {table}_staging s ON s.{key} = t.{key};
+    """)
+    changed, missing = cur.fetchone()
+    check_append_only(table, changed, missing)
+    
+    cur.execute(f"""
+        INSERT INTO {table} SELECT * FROM {table}_staging
+        ON CONFLICT ({key}) DO NOTHING;
+    """)
+    # one whole line per table, tracks and region load on separate threads
+    print(f"  Loaded {table}")
 
 
-def load_parquet_chunked(cur, conn, table, filepath, chunk_sz=CHUNK_SIZE):
-    """Load big parquet files in chunks to avoid memory issues"""
+def load_csv_own_connection(table, filepath):
+    """Load a CSV on its own connection so dimension tables can load in parallel"""
+    conn = psycopg.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    try:
+        load_csv(cur, table, filepath)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def load_parquet_chunked(cur, table, filepath, chunk_sz=CHUNK_SIZE):
+    """Stream parquet batches into postgres with a binary COPY"""
     if not os.path.exists(filepath):
         print(f"Warning: {filepath} not found")
         return
     
     # dedupe first and get clean file path
-    result = dedupe_chart_entries(filepath)
-    if isinstance(result, tuple):
-        df, clean_path = result
-    else:
-        df = result
-        clean_path = filepath
+    clean_path = dedupe_chart_entries(filepath)
     
-    total = len(df)
+    pf = pq.ParquetFile(clean_path)
+    total = pf.metadata.num_rows
     chunks = (total + chunk_sz - 1) // chunk_sz
+    columns = CHART_ENTRIES_SCHEMA.names
     
     print(f"\nLoading {table} ({total:,} rows in {chunks} chunks)...")
     
-    for i in range(0, total, chunk_sz):
-        chunk = df.iloc[i:i+chunk_sz]
-        buf = StringIO()
-        chunk.to_csv(buf, index=False, header=False)
-        buf.seek(0)
+    # the queued writer hands data to libpq on a background thread, so encoding
+    # the next batch overlaps the socket writes of the last one
+    encoder = ArrowToPostgresBinaryEncoder(CHART_ENTRIES_SCHEMA)
+    with cur.copy(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT BINARY)",
+        writer=QueuedLibpqWriter(cur)
+    ) as copy:
+        copy.write(encoder.write_header())
         
-        cur.copy_from(buf, table, sep=',', null='')
-        conn.commit()
+        for chunk_num, batch in enumerate(pf.iter_batches(batch_size=chunk_sz, columns=columns), start=1):
+            # cast to the table types (pandas writes int64 for every id column)
+            batch = pa.RecordBatch.from_arrays(
+                [batch.column(f.name).cast(f.type) for f in CHART_ENTRIES_SCHEMA],
+                schema=CHART_ENTRIES_SCHEMA
+            )
+            copy.write(encoder.write_batch(batch))
+            print(f"  [{chunk_num}/{chunks}] {batch.num_rows:,} rows")
         
-        chunk_num = i // chunk_sz + 1
-        print(f"  [{chunk_num}/{chunks}] {len(chunk):,} rows")
+        copy.write(encoder.finish())
+    
+    print(f"  Copied {total:,} rows")
+
+
+def load_staging(cur, filepath):
+    """Bulk load the fact file into the empty staging table"""
+    cur.execute("TRUNCATE chart_entries_staging;")
+    load_parquet_chunked(cur, "chart_entries_staging", filepath)
+
+
+def merge_chart_entries(cur):
+    """Upsert the new and higher streams rows from staging into chart_entries"""
+    cols = ", ".join(CHART_ENTRIES_SCHEMA.names)
+    staged = ", ".join(f"s.{c}" for c in CHART_ENTRIES_SCHEMA.names)
+    moved = """
+        s.entry_id IS NOT NULL AND c.entry_id IS NOT NULL
+        AND (s.artist_id, s.track_id, s.region_id, s.chart_position)
+            IS DISTINCT FROM (c.artist_id, c.track_id, c.region_id, c.chart_position)
+    """
+    print("\nMerging staged rows into chart_entries...")
+    
+    # one join over staging and the loaded rows keeps only what differs, which is both
+    # the append-only check and the rows to write, unchanged rows never reach the upsert
+    cur.execute(f"""
+        CREATE TEMP TABLE chart_entries_diff ON COMMIT DROP AS
+        SELECT {staged}, ({moved}) AS moved
+        FROM chart_entries_staging s
+        FULL JOIN chart_entries c
+          ON s.entry_id = c.entry_id AND s.chart_date = c.chart_date
+        WHERE c.entry_id IS NULL
+           OR s.entry_id IS NULL
+           OR s.streams > c.streams
+           OR ({moved});
+    """)
+    
+    # only streams may change for an existing entry, anything else means the ids moved
+    cur.execute("""
+        SELECT COUNT(*) FILTER (WHERE moved), COUNT(*) FILTER (WHERE entry_id IS NULL)
+        FROM chart_entries_diff;
+    """)
+    changed, missing = cur.fetchone()
+    check_append_only("chart_entries", changed, missing)
+    
+    # what's left is new entries and entries whose streams went up
+    cur.execute(f"""
+        INSERT INTO chart_entries ({cols})
+        SELECT {cols} FROM chart_entries_diff
+        ON CONFLICT (entry_id, chart_date) DO UPDATE
+        SET streams = EXCLUDED.streams;
+    """)
+    print(f"  {cur.rowcount:,} rows inserted/updated")
+    cur.execute("TRUNCATE chart_entries_staging;")
 
 
 def show_stats(cur):
@@ -198,6 +397,7 @@ def show_stats(cur):
                pg_size_pretty(pg_total_relation_size(schemaname||'.'||tablename))
         FROM pg_tables
         WHERE tablename LIKE 'chart_entries_%'
+          AND tablename <> 'chart_entries_staging'
         ORDER BY tablename;
     """)
     for row in cur.fetchall():
@@ -205,12 +405,12 @@ def show_stats(cur):
 
 
 def main():
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = psycopg.connect(**DB_CONFIG)
     cur = conn.cursor()
     
     try:
         print("Setting up schema...")
-        setup_schema(cur)
+        setup_schema(cur, FULL_RELOAD)
         conn.commit()
         
         setup_partitions(cur, TABLE_FILES["chart_entries"])
@@ -220,14 +420,25 @@ def main():
         load_csv(cur, "artists", TABLE_FILES["artists"])
         conn.commit()
         
-        load_csv(cur, "tracks", TABLE_FILES["tracks"])
-        conn.commit()
-        
-        load_csv(cur, "region", TABLE_FILES["region"])
-        conn.commit()
+        # tracks only references artists, so tracks and region can load side by side
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            futures = [ex.submit(load_csv_own_connection, t, TABLE_FILES[t]) for t in ("tracks", "region")]
+            for fut in futures:
+                fut.result()
         
+        # load and key/merge the fact table in a single transaction with one commit,
+        # and don't make that commit wait on the WAL flush
         print("\nLoading fact table...")
-        load_parquet_chunked(cur, conn, "chart_entries", TABLE_FILES["chart_entries"])
+        cur.execute("SET LOCAL synchronous_commit = OFF")
+        if chart_entries_has_keys(cur):
+            load_staging(cur, TABLE_FILES["chart_entries"])
+            merge_chart_entries(cur)
+        else:
+            # first run, the table is empty so COPY straight in and key it afterwards
+            load_parquet_chunked(cur, "chart_entries", TABLE_FILES["chart_entries"])
+            add_chart_entries_constraints(cur)
+        add_chart_entries_indexes(cur)
+        conn.commit()
         
         show_stats(cur)
         print("\nAll done!")
@@ -3,8 +3,8 @@ Generate some reports from the Spotify charts database
 """
 
 import os
-import psycopg2
-import pandas as pd
+import psycopg
+from datetime import date
 from dotenv import load_dotenv
 
 load_dotenv("local.env")
@@ -27,31 +27,27 @@ CHART_DATE = "2021-12-07"
 REGION_ID = 66 
 
 
-def get_top_tracks(conn, year):
-    """Top 10 tracks by total streams for a year"""
-    query = f"""
+def top_tracks_query(year):
+    """SQL and params for the top 10 tracks by total streams for a year"""
+    query = """
         SELECT 
             t.track_name,
             a.artist_name,
-            SUM(c.streams) AS total_streams
+            to_char(SUM(c.streams), 'FM999,999,999,999') AS total_streams
         FROM chart_entries c
         JOIN tracks t ON c.track_id = t.track_id
         JOIN artists a ON t.artist_id = a.artist_id
-        WHERE EXTRACT(YEAR FROM c.chart_date) = {year}
+        WHERE c.chart_date >= %s AND c.chart_date < %s
         GROUP BY t.track_name, a.artist_name
-        ORDER BY total_streams DESC
-        LIMIT 10;
+        ORDER BY SUM(c.streams) DESC
+        LIMIT 10
     """
+    # plain range on the partition key so only that year's partition is scanned
+    return query, (date(year, 1, 1), date(year + 1, 1, 1))
 
-    df = pd.read_sql_query(query, conn)
-    
-    df['total_streams'] = df['total_streams'].astype(int).apply(lambda x: f"{x:,}")
-    
-    return df
 
-
-def get_top_artists(conn):
-    """Artists with most unique songs"""
+def top_artists_query():
+    """SQL and params for the artists with most unique songs"""
     query = """
         SELECT 
             a.artist_name,
@@ -60,14 +56,14 @@ def get_top_artists(conn):
         JOIN tracks t ON a.artist_id = t.artist_id
         GROUP BY a.artist_name
         ORDER BY unique_song_count DESC
-        LIMIT 50;
+        LIMIT 50
     """
-    return pd.read_sql_query(query, conn)
+    return query, None
 
 
-def get_chart_snapshot(conn, CHART_DATE, region):
-    """Get top 200 for a specific date and region"""
-    query = f"""
+def chart_snapshot_query(CHART_DATE, region):
+    """SQL and params for the top 200 on a specific date and region"""
+    query = """
         SELECT 
             c.entry_id,
             c.chart_date,
@@ -78,48 +74,52 @@ def get_chart_snapshot(conn, CHART_DATE, region):
             a.artist_name,
             r.region_id,
             r.country_name,
-            c.streams
+            to_char(c.streams, 'FM999,999,999,999') AS streams
         FROM chart_entries c
         LEFT JOIN tracks t ON c.track_id = t.track_id
         LEFT JOIN artists a ON c.artist_id = a.artist_id
         LEFT JOIN region r ON c.region_id = r.region_id
-        WHERE c.chart_date = '{CHART_DATE}'
-          AND c.region_id = {region}
+        WHERE c.chart_date = %s
+          AND c.region_id = %s
         ORDER BY c.chart_position ASC
-        LIMIT 200;
+        LIMIT 200
     """
-    df = pd.read_sql_query(query, conn)
-    
-    # Convert to int first to remove decimals, then format with commas
-    df['streams'] = df['streams'].astype(int).apply(lambda x: f"{x:,}")
-    
-    return df
+    return query, (CHART_DATE, region)
+
+
+def export_csv(conn, query, params, output):
+    """Stream query results straight to a CSV file with COPY"""
+    # postgres writes the CSV itself (streams are comma formatted in the query)
+    with conn.cursor() as cur, open(output, "wb") as f:
+        # COPY can't take bind parameters, so psycopg quotes the values into the
+        # SQL as literals client-side. That keeps them injection safe, but the
+        # server still parses and plans every query from scratch (no plan caching)
+        with cur.copy(f"COPY ({query}) TO STDOUT WITH CSV HEADER", params) as copy:
+            for data in copy:
+                f.write(data)
 
 
 def main():
     print("Connecting to database...")
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = psycopg.connect(**DB_CONFIG)
     
     try:
         # report 1 - top tracks for year
         print(f"Generating top tracks for {YEAR}...")
-        df = get_top_tracks(conn, YEAR)
         output = os.path.join(EXPORT_DIR, f"top_10_tracks_{YEAR}.csv")
-        df.to_csv(output, index=False)
+        export_csv(conn, *top_tracks_query(YEAR), output)
         print(f"  Saved: {output}")
         
         # report 2 - artists by song count
         print("Generating top artists by unique songs...")
-        df = get_top_artists(conn)
         output = os.path.join(EXPORT_DIR, "top_50_artists_by_songs.csv")
-        df.to_csv(output, index=False)
+        export_csv(conn, *top_artists_query(), output)
         print(f"  Saved: {output}")
         
         # report 3 - chart snapshot
         print(f"Generating chart for {CHART_DATE} (region {REGION_ID})...")
-        df = get_chart_snapshot(conn, CHART_DATE, REGION_ID)
         output = os.path.join(EXPORT_DIR, f"top_200_{CHART_DATE}_region{REGION_ID}.csv")
-        df.to_csv(output, index=False)
+        export_csv(conn, *chart_snapshot_query(CHART_DATE, REGION_ID), output)
         print(f"  Saved: {output}")
         
         print("\nAll reports generated")